@@ -6,6 +6,8 @@ DROP TABLE IF EXISTS paciente CASCADE;
 DROP TABLE IF EXISTS receita CASCADE;
 DROP TABLE IF EXISTS consulta CASCADE;
 DROP TABLE IF EXISTS observacao CASCADE;
+DROP SEQUENCE IF EXISTS codigo_sns_seq;
+DROP TABLE IF EXISTS versao_tabela CASCADE;
 CREATE TABLE clinica(
 nome VARCHAR(80) PRIMARY KEY,
 telefone VARCHAR(15) UNIQUE NOT NULL CHECK (telefone ~ '^[0-9]+$'),
@@ -50,6 +52,7 @@ codigo_sns CHAR(12) UNIQUE CHECK (codigo_sns ~ '^[0-9]+$'),
 UNIQUE(ssn, data, hora),
 UNIQUE(nif, data, hora)
 );
+CREATE SEQUENCE codigo_sns_seq;
 CREATE TABLE receita(
 codigo_sns VARCHAR(12) NOT NULL REFERENCES consulta (codigo_sns),
 medicamento VARCHAR(155) NOT NULL,
@@ -61,4 +64,35 @@ id INTEGER NOT NULL REFERENCES consulta,
 parametro VARCHAR(155) NOT NULL,
 valor FLOAT,
 PRIMARY KEY (id, parametro)
-);
\ No newline at end of file
+);
+
+-- Versao de cada tabela de referencia, usada pela API para gerar os ETag
+-- e Last-Modified do catalogo sem reler os dados. A versao volta a 0 sempre
+-- que este script corre, por isso o ETag leva tambem a epoca, sorteada aqui,
+-- para nao coincidir com o de uma instalacao anterior.
+CREATE TABLE versao_tabela(
+tabela VARCHAR(80) PRIMARY KEY,
+versao BIGINT NOT NULL DEFAULT 0,
+epoca CHAR(8) NOT NULL DEFAULT substr(md5(random()::text || clock_timestamp()::text), 1, 8),
+modificada TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+INSERT INTO versao_tabela (tabela) VALUES ('clinica'), ('medico'), ('trabalha');
+
+-- Incrementa a versao e avisa a cache de dados de referencia da API
+-- (saude_api/refdata.py) sempre que clinica, medico ou trabalha mudam.
+CREATE OR REPLACE FUNCTION notify_refdata() RETURNS TRIGGER AS $$
+    BEGIN
+        UPDATE versao_tabela
+            SET versao = versao + 1, modificada = now()
+            WHERE tabela = TG_TABLE_NAME;
+        PERFORM pg_notify('refdata', TG_TABLE_NAME);
+        RETURN NULL;
+    END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER clinica_refdata_trigger AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON clinica
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_refdata();
+CREATE OR REPLACE TRIGGER medico_refdata_trigger AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON medico
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_refdata();
+CREATE OR REPLACE TRIGGER trabalha_refdata_trigger AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON trabalha
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_refdata();
@@ -0,0 +1,392 @@
+#!/usr/bin/python3
+# Copyright (c) BDist Development Team
+# Distributed under the terms of the Modified BSD License.
+''' Async (ASGI) serving mode of the saude API.
+
+Same routes, queries and answers as app.py, served by Quart on psycopg's
+AsyncConnection and an AsyncConnectionPool, so a worker keeps serving other
+requests while one waits on Postgres. Run it with an ASGI server, e.g.
+
+    hypercorn asgi:app --workers 4
+
+It reads the same FLASK_* settings as app.py. '''
+from datetime import datetime
+
+import psycopg
+from psycopg.rows import namedtuple_row
+from psycopg_pool import AsyncConnectionPool
+from quart import Quart, Response, jsonify, make_response, request
+
+import app as wsgi
+import metrics
+from availability import SEARCH_FREE_SLOTS, afirst_free_slots, asearch_free_slots, search_params
+from statements import registry
+from streaming import astream_rows, mimetype, wants_ndjson
+
+app = Quart(__name__)
+config = wsgi.app.config
+log = app.logger
+refdata = wsgi.refdata
+
+pool = AsyncConnectionPool(
+    conninfo=wsgi.DATABASE_URL,
+    min_size=config["POOL_MIN_SIZE"],
+    max_size=config["POOL_MAX_SIZE"],
+    max_idle=config["POOL_MAX_IDLE"],
+    max_lifetime=config["POOL_MAX_LIFETIME"],
+    timeout=config["POOL_TIMEOUT"],
+    kwargs={"autocommit": True, "cursor_factory": metrics.AsyncInstrumentedCursor},
+    name="saude-async",
+    open=False,
+)
+
+
+@app.before_serving
+async def open_pool():
+    await pool.open()
+    if config["REFDATA_LISTEN"]:
+        refdata.listen(wsgi.DATABASE_URL)
+
+
+@app.after_serving
+async def close_pool():
+    await pool.close()
+
+
+@app.before_request
+async def start_metrics():
+    if config["METRICS"]:
+        metrics.start()
+
+
+@app.after_request
+async def finish_metrics(response):
+    stats = metrics.finish(metrics.route_label(request), request.method, response.status_code)
+    if stats is not None:
+        response.headers["Server-Timing"] = metrics.server_timing(stats)
+    return response
+
+
+
+@app.route("/", methods=("GET",))
+async def list_clinicas():
+    ''' Lists all clinics (name and address). '''
+
+    async with pool.connection() as conn:
+        async with conn.cursor(row_factory=namedtuple_row) as cur:
+            await registry.aexecute(cur, wsgi.CATALOG_VERSION, (["clinica"],))
+            etag, modificada = wsgi.catalog_validators(await cur.fetchall())
+            if wsgi.catalog_not_modified(request, etag, modificada):
+                return wsgi.catalog_response(await make_response("", 304), etag, modificada)
+
+            await registry.aexecute(cur, wsgi.LIST_CLINICAS)
+            clinicas = await cur.fetchall()
+            log.debug(f"Found {cur.rowcount} rows.")
+
+    return wsgi.catalog_response(jsonify(clinicas), etag, modificada)
+
+
+
+@app.route("/c/<clinica>/", methods=("GET",))
+async def list_especialidades(clinica):
+    """ Lists all specialities in <clinica>."""
+
+    async with pool.connection() as conn:
+        async with conn.cursor(row_factory=namedtuple_row) as cur:
+
+            if clinica not in (await refdata.aget(cur)).clinicas:
+                return jsonify({'status': 'error', 'message': 'A clinica nao existe.'}), 400
+
+            await registry.aexecute(cur, wsgi.CATALOG_VERSION, (["clinica", "medico", "trabalha"],))
+            etag, modificada = wsgi.catalog_validators(await cur.fetchall())
+            if wsgi.catalog_not_modified(request, etag, modificada):
+                return wsgi.catalog_response(await make_response("", 304), etag, modificada)
+
+            await registry.aexecute(cur, wsgi.LIST_ESPECIALIDADES, (clinica,))
+            especialidades = await cur.fetchall()
+            log.debug(f"Found {cur.rowcount} rows.")
+
+    res = [e[0] for e in especialidades]
+    return wsgi.catalog_response(jsonify(res), etag, modificada)
+
+
+
+@app.route("/c/<clinica>/<especialidade>/", methods=("GET",))
+async def list_medicos(clinica, especialidade):
+    ''' Lists all doctors (name) from <especialidade> who work in
+    <clinica> and the first 3 available hours for consultation of
+    each of them (date and time). '''
+
+    async with pool.connection() as conn:
+        async with conn.cursor(row_factory=namedtuple_row) as cur:
+            ref = await refdata.aget(cur)
+
+            error = []
+            if clinica not in ref.clinicas:
+                error.append('Clinica invalida.')
+
+            if especialidade not in ref.especialidades:
+                error.append('Especialidade invalida.')
+
+            if error:
+                return jsonify({'status': 'error', 'message': '  '.join(error)}), 400
+
+            if especialidade not in ref.especialidades_clinica.get(clinica, ()):
+                return jsonify({'status': 'error', 'message':
+                                'Nao existem medicos desta especialidade nesta clinica.'}), 400
+
+            # todos os medicos numa so query (ver availability.py)
+            result = await afirst_free_slots(
+                cur, clinica, especialidade, wsgi.round_up_to_next_half_hour(datetime.now()))
+            log.debug(f"Found {cur.rowcount} rows.")
+
+    return jsonify(result)
+
+
+
+@app.route("/disponibilidade/", methods=("GET",))
+async def search_disponibilidade():
+    ''' Lists free appointment slots over a range of days (see
+    wsgi.search_disponibilidade()). '''
+
+    pesquisa, error = wsgi.pesquisa_params(request.args)
+    if error:
+        return jsonify({'status': 'error', 'message': '  '.join(error)}), 400
+
+    async with pool.connection() as conn:
+        async with conn.cursor(row_factory=namedtuple_row) as cur:
+            error = wsgi.pesquisa_errors(await refdata.aget(cur), pesquisa)
+            if error:
+                return jsonify({'status': 'error', 'message': '  '.join(error)}), 400
+
+            if wants_ndjson(request):
+                return astream_rows(
+                    pool.connection, SEARCH_FREE_SLOTS,
+                    search_params(limite=None, **wsgi.pesquisa_filtros(pesquisa)),
+                    wsgi.slot_json, True, config["STREAM_ITERSIZE"]), {"Content-Type": mimetype(True)}
+
+            rows = await asearch_free_slots(
+                cur, limite=pesquisa.limite + 1, **wsgi.pesquisa_filtros(pesquisa))
+            log.debug(f"Found {len(rows)} rows.")
+
+    return jsonify(wsgi.pesquisa_response(rows, pesquisa.limite))
+
+
+
+async def validate_consulta(clinica, paciente, medico, consulta_datetime, cur):
+    ''' wsgi.validate_consulta() for an async cursor. '''
+    params = wsgi.validate_params(clinica, paciente, medico, consulta_datetime)
+    await registry.aexecute(cur, wsgi.VALIDATE_CONSULTA, params)
+    row = await cur.fetchone()
+    return wsgi.validacao(await refdata.aget(cur), params, row)
+
+
+@app.route('/a/<clinica>/registar/', methods=("POST",))
+async def register_consulta(clinica):
+    ''' Registers new appointment in <clinica>. '''
+
+    paciente = request.args.get("paciente")
+    medico = request.args.get("medico")
+    data_consulta = request.args.get("data")
+    hora_consulta = request.args.get("hora")
+
+    async with pool.connection() as conn:
+        async with conn.cursor(row_factory=namedtuple_row) as cur:
+            try:
+                consulta_datetime = datetime.strptime(f"{data_consulta} {hora_consulta}", '%Y-%m-%d %H:%M:%S')
+                valid = await validate_consulta(clinica, paciente, medico, consulta_datetime, cur)
+
+                error = wsgi.register_errors(valid, paciente, medico, data_consulta,
+                                             hora_consulta, consulta_datetime)
+                if error:
+                    return jsonify({'status': 'error', 'message': '  '.join(error)}), 400
+
+                while True:
+                    await registry.aexecute(cur, wsgi.NEXTVAL_CODIGO_SNS)
+                    codigo_sns = wsgi.sns.codigo_sns((await cur.fetchone())[0])
+                    try:
+                        await registry.aexecute(
+                            cur, wsgi.INSERT_CONSULTA,
+                            {"paciente": paciente,
+                            "medico": medico,
+                            "clinica": clinica,
+                            "data_consulta": data_consulta,
+                            "hora_consulta": hora_consulta,
+                            "codigo_sns": codigo_sns},
+                        )
+                        id = (await cur.fetchone())[0]
+                        break
+                    except psycopg.errors.UniqueViolation as e:
+                        if e.diag.constraint_name in wsgi.CONFLITOS_CONSULTA:
+                            return jsonify({'status': 'error', 'message':
+                                            wsgi.CONFLITOS_CONSULTA[e.diag.constraint_name]}), 400
+                        if e.diag.constraint_name != 'consulta_codigo_sns_key':
+                            raise
+                response = {'status': 'success', 'message': 'Consulta registrada com sucesso.', 'id': id}
+
+            except Exception as e:
+                response = {'status': 'error', 'message': f'Erro ao registrar consulta: {str(e)}'}
+
+    return jsonify(response)
+
+
+
+@app.route('/a/<clinica>/registar/lote/', methods=("POST",))
+async def register_lote(clinica):
+    ''' Registers a batch of appointments in <clinica> (see wsgi.register_lote()). '''
+
+    itens = await request.get_json(silent=True)
+    error = wsgi.lote_error(itens)
+    if error:
+        return jsonify({'status': 'error', 'message': error}), 400
+
+    resultados = [None] * len(itens)
+    marcacoes = wsgi.lote_marcacoes(clinica, itens, resultados)
+
+    async with pool.connection() as conn:
+        async with conn.cursor(row_factory=namedtuple_row) as cur:
+            try:
+                pendentes = marcacoes
+                while pendentes:
+                    await registry.aexecute(cur, wsgi.VALIDATE_LOTE, wsgi.lote_params(clinica, pendentes))
+                    rows = await cur.fetchall()
+                    validas = wsgi.lote_validas(await refdata.aget(cur), pendentes, rows, resultados)
+                    if not validas:
+                        break
+
+                    await registry.aexecute(cur, wsgi.NEXTVAL_LOTE, (len(validas),))
+                    ns = await cur.fetchall()
+                    codigos = {wsgi.sns.codigo_sns(n[0]): m for n, m in zip(ns, validas)}
+                    try:
+                        await registry.aexecute(
+                            cur, wsgi.INSERT_LOTE, wsgi.insert_lote_params(clinica, codigos))
+                        inseridas = await cur.fetchall()
+                    except psycopg.Error:
+                        inseridas = []
+                    if not inseridas:
+                        for m in validas:
+                            resultados[m.i] = await lote_insert(cur, clinica, m)
+                        break
+                    pendentes = wsgi.lote_inseridas(codigos, inseridas, resultados)
+
+            except Exception as e:
+                wsgi.lote_falhadas(marcacoes, resultados, e)
+
+    return jsonify(wsgi.lote_response(resultados))
+
+
+
+async def lote_insert(cur, clinica, m):
+    ''' wsgi.lote_insert() for an async cursor. '''
+    while True:
+        await registry.aexecute(cur, wsgi.NEXTVAL_CODIGO_SNS)
+        codigo_sns = wsgi.sns.codigo_sns((await cur.fetchone())[0])
+        try:
+            await registry.aexecute(cur, wsgi.INSERT_CONSULTA, wsgi.insert_consulta_params(clinica, m, codigo_sns))
+            id = (await cur.fetchone())[0]
+            return {'status': 'success', 'message': 'Consulta registrada com sucesso.', 'id': id}
+        except psycopg.Error as e:
+            if not (isinstance(e, psycopg.errors.UniqueViolation)
+                    and e.diag.constraint_name == 'consulta_codigo_sns_key'):
+                return wsgi.insert_error(e)
+
+
+@app.route('/a/<clinica>/cancelar/', methods=("POST",))
+async def cancel_consulta(clinica):
+    ''' Cancels an appointment that hasn't taken place yet at <clinica>. '''
+
+    paciente = request.args.get("paciente")
+    medico = request.args.get("medico")
+    data_consulta = request.args.get("data")
+    hora_consulta = request.args.get("hora")
+
+    async with pool.connection() as conn:
+        async with conn.cursor(row_factory=namedtuple_row) as cur:
+            try:
+                await cur.execute("BEGIN;")
+
+                consulta_datetime = datetime.strptime(f"{data_consulta} {hora_consulta}", '%Y-%m-%d %H:%M:%S')
+                valid = await validate_consulta(clinica, paciente, medico, consulta_datetime, cur)
+
+                error = wsgi.cancel_errors(valid, paciente, medico, data_consulta,
+                                           hora_consulta, consulta_datetime)
+                if error:
+                    await cur.execute("ROLLBACK;")
+                    return jsonify({'status': 'error', 'message': '  '.join(error)}), 400
+
+                await registry.aexecute(
+                    cur, wsgi.SELECT_CONSULTA_FOR_UPDATE,
+                    (paciente, medico, clinica, data_consulta, hora_consulta)
+                )
+                consulta = await cur.fetchone()
+                if consulta is None:
+                    await cur.execute("ROLLBACK;")
+                    return jsonify({'status': 'error', 'message':
+                                    'Consulta nao encontrada ou ja cancelada.'}), 404
+                codigo_sns, id = consulta
+
+                for delete in wsgi.DELETE_CONSULTA:
+                    await registry.aexecute(cur, delete, {"codigo_sns": codigo_sns, "id": id})
+                await cur.execute("COMMIT;")
+                response = {'status': 'success', 'message': 'Consulta cancelada com sucesso.'}
+            except Exception as e:
+                await cur.execute('ROLLBACK')
+                response = {'status': 'error', 'message': f'Erro ao cancelar consulta: {str(e)}'}
+
+    return jsonify(response)
+
+
+
+@app.route('/a/<clinica>/consultas/', methods=("GET",))
+async def list_consultas(clinica):
+    ''' Streams every appointment at <clinica> (see wsgi.list_consultas()). '''
+
+    params, error = wsgi.consultas_params(clinica, request.args)
+    async with pool.connection() as conn:
+        async with conn.cursor(row_factory=namedtuple_row) as cur:
+            if clinica not in (await refdata.aget(cur)).clinicas:
+                error.insert(0, 'Clinica invalida.')
+    if error:
+        return jsonify({'status': 'error', 'message': '  '.join(error)}), 400
+
+    ndjson = wants_ndjson(request)
+    return astream_rows(pool.connection, wsgi.LIST_CONSULTAS, params, wsgi.consulta_json, ndjson,
+                        config["STREAM_ITERSIZE"]), {"Content-Type": mimetype(ndjson)}
+
+
+
+@app.route("/stats/pool/", methods=("GET",))
+async def pool_stats():
+    ''' Shows the connection pool health and wait-time statistics. '''
+
+    stats = pool.get_stats()
+    stats["pool_open"] = not pool.closed
+    if stats.get("requests_num"):
+        stats["requests_wait_ms_avg"] = stats.get("requests_wait_ms", 0) / stats["requests_num"]
+
+    return jsonify(stats)
+
+
+
+@app.route("/stats/cache/", methods=("GET",))
+async def cache_stats():
+    ''' Shows the reference data cache hit/miss counters. '''
+
+    return jsonify(refdata.stats())
+
+
+
+@app.route("/metrics", methods=("GET",))
+async def prometheus_metrics():
+    ''' Shows the route metrics in the Prometheus text format. '''
+
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+
+@app.route("/stats/statements/", methods=("GET",))
+async def statement_stats():
+    ''' Shows how many times each registered statement ran and for how
+    long, the most expensive first. '''
+
+    return jsonify(registry.stats())
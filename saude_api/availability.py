@@ -0,0 +1,225 @@
+# Copyright (c) BDist Development Team
+# Distributed under the terms of the Modified BSD License.
+''' Set-based availability engine.
+
+Free appointment slots are computed for every matching doctor in a single
+query, instead of probing consulta one half hour at a time. The same is
+done for searches over a range of days, paginated with a keyset cursor. '''
+import base64
+from datetime import datetime, time, timedelta
+
+from statements import registry
+
+# How far ahead to look for free slots. Postgres builds the whole
+# generate_series of a window for every doctor before the LIMIT, so
+# first_free_slots() searches in growing windows (see JANELA) and only
+# reaches the horizon for doctors that are booked solid.
+HORIZONTE = timedelta(days=366)
+
+# Candidate slots are the ones accepted by valid_working_time(), i.e. every
+# half hour in 08:00-12:30 and 14:00-18:30 from <inicio> onwards, on the
+# week days the doctor works at <clinica> (sunday = 0). <nifs> (NULL for
+# every doctor) restricts the search to the doctors still missing slots.
+FIRST_FREE_SLOTS = registry.register("first_free_slots", """
+    SELECT m.nome, m.nif, s.data, s.hora
+    FROM (
+        SELECT DISTINCT m.nome, m.nif
+        FROM medico m
+        JOIN trabalha t ON m.nif = t.nif
+        WHERE t.nome = %(clinica)s
+        AND m.especialidade = %(especialidade)s
+        AND EXISTS (SELECT 1 FROM consulta c WHERE c.nif = m.nif)
+        AND (%(nifs)s::bpchar[] IS NULL OR m.nif = ANY(%(nifs)s::bpchar[]))
+    ) m
+    LEFT JOIN LATERAL (
+        SELECT slot::date AS data, slot::time AS hora
+        FROM generate_series(%(inicio)s::timestamp, %(fim)s::timestamp,
+                             interval '30 minutes') AS slot
+        JOIN trabalha t
+            ON t.nif = m.nif
+            AND t.nome = %(clinica)s
+            AND t.dia_da_semana = EXTRACT(DOW FROM slot)::smallint
+        WHERE slot::time BETWEEN '08:00' AND '18:30'
+        AND (slot::time <= '12:30' OR slot::time >= '14:00')
+        AND NOT EXISTS (
+            SELECT 1
+            FROM consulta c
+            WHERE c.nif = m.nif
+            AND c.data = slot::date
+            AND c.hora = slot::time
+        )
+        ORDER BY slot
+        LIMIT %(n)s
+    ) s ON TRUE
+    ORDER BY m.nome, s.data, s.hora;
+""")
+
+
+def first_free_slots(cur, clinica, especialidade, inicio, n=3):
+    ''' Gets the first <n> free slots, starting at <inicio>, of every doctor
+    of <especialidade> working at <clinica>, one round trip per window of
+    days (usually just the first one).
+    Returns {medico_nome: [{'data': ..., 'hora': ...}, ...]}. '''
+
+    slots = {}
+    for params in first_free_windows(clinica, especialidade, inicio, n, slots):
+        add_slots(slots, registry.execute(cur, FIRST_FREE_SLOTS, params).fetchall(), n)
+    return group_slots(slots)
+
+
+async def afirst_free_slots(acur, clinica, especialidade, inicio, n=3):
+    ''' first_free_slots() for an async cursor. '''
+
+    slots = {}
+    for params in first_free_windows(clinica, especialidade, inicio, n, slots):
+        await registry.aexecute(acur, FIRST_FREE_SLOTS, params)
+        add_slots(slots, await acur.fetchall(), n)
+    return group_slots(slots)
+
+
+def first_free_windows(clinica, especialidade, inicio, n, slots):
+    ''' Yields the FIRST_FREE_SLOTS parameters of each window of days, from
+    JANELA up to HORIZONTE, doubling every time, until every doctor in
+    <slots> (filled in by the caller between windows) has <n> slots. '''
+    fim = inicio + HORIZONTE
+    janela = JANELA
+    nifs = None
+    while inicio < fim:
+        ate = min(fim, inicio + janela)
+        yield {"clinica": clinica,
+               "especialidade": especialidade,
+               "inicio": inicio,
+               # o fim do generate_series e inclusivo
+               "fim": ate - timedelta(minutes=30),
+               "nifs": nifs,
+               "n": n}
+        nifs = [nif for nif, (_nome, livres) in slots.items() if len(livres) < n]
+        if not nifs:
+            return
+        inicio = ate
+        janela *= 2
+
+
+def add_slots(slots, rows, n):
+    ''' Adds the FIRST_FREE_SLOTS <rows> of one window to <slots>
+    ({nif: (nome, slots)}, by doctor name), up to <n> per doctor. '''
+    for nome, nif, data, hora in rows:
+        _nome, livres = slots.setdefault(nif, (nome, []))
+        if data is not None and len(livres) < n:
+            livres.append({'data': str(data), 'hora': str(hora)})
+
+
+def group_slots(slots):
+    return {nome: livres for nome, livres in slots.values() if livres}
+
+
+# Half-hour slots accepted by valid_working_time().
+HORAS = [time(h, m) for h in (8, 9, 10, 11, 12, 14, 15, 16, 17, 18) for m in (0, 30)]
+
+# First window of days searched by first_free_slots() and
+# search_free_slots(); it doubles every round until they have enough slots.
+JANELA = timedelta(days=7)
+
+# Free slots between <inicio> and <fim> of every doctor matching the
+# optional filters, in (data, hora, nif) order, after the <depois> key.
+SEARCH_FREE_SLOTS = registry.register("search_free_slots", """
+    SELECT s.data, s.hora, t.nome AS clinica, m.nif, m.nome, m.especialidade
+    FROM (
+        SELECT dia::date AS data, hora
+        FROM generate_series(%(inicio)s::date, %(fim)s::date, interval '1 day') AS dia,
+             unnest(%(horas)s::time[]) AS hora
+    ) s
+    JOIN trabalha t ON t.dia_da_semana = EXTRACT(DOW FROM s.data)::smallint
+    JOIN medico m ON m.nif = t.nif
+    WHERE s.data + s.hora >= %(agora)s
+    AND (s.data, s.hora, m.nif) > (%(data)s::date, %(hora)s::time, %(nif)s::bpchar)
+    AND (%(clinica)s::varchar IS NULL OR t.nome = %(clinica)s)
+    AND (%(especialidade)s::varchar IS NULL OR m.especialidade = %(especialidade)s)
+    AND (%(medico)s::bpchar IS NULL OR m.nif = %(medico)s)
+    AND NOT EXISTS (
+        SELECT 1
+        FROM consulta c
+        WHERE c.nif = m.nif
+        AND c.data = s.data
+        AND c.hora = s.hora
+    )
+    ORDER BY s.data, s.hora, m.nif
+    LIMIT %(n)s;
+""")
+
+
+def search_free_slots(cur, inicio, fim, agora, limite, depois=None,
+                      clinica=None, especialidade=None, medico=None):
+    ''' Gets up to <limite> free slots from <inicio> to <fim> (dates), not
+    before <agora>, of the doctors matching <clinica>, <especialidade> and
+    <medico>, in (data, hora, nif) order and after the <depois> key.
+    The range is searched in growing windows of days, so the cost of a page
+    depends on <limite> rather than on how far <fim> is. '''
+
+    rows = []
+    for params in search_windows(inicio, fim, agora, depois, clinica, especialidade, medico):
+        params["n"] = limite - len(rows)
+        rows.extend(registry.execute(cur, SEARCH_FREE_SLOTS, params).fetchall())
+        if len(rows) >= limite:
+            break
+    return rows
+
+
+async def asearch_free_slots(acur, inicio, fim, agora, limite, depois=None,
+                             clinica=None, especialidade=None, medico=None):
+    ''' search_free_slots() for an async cursor. '''
+
+    rows = []
+    for params in search_windows(inicio, fim, agora, depois, clinica, especialidade, medico):
+        params["n"] = limite - len(rows)
+        await registry.aexecute(acur, SEARCH_FREE_SLOTS, params)
+        rows.extend(await acur.fetchall())
+        if len(rows) >= limite:
+            break
+    return rows
+
+
+def search_windows(inicio, fim, agora, depois, clinica, especialidade, medico):
+    ''' Yields the SEARCH_FREE_SLOTS parameters of each window of days. '''
+    params = search_params(inicio, fim, agora, None, depois, clinica, especialidade, medico)
+    dia = params["inicio"]
+    janela = JANELA
+    while dia <= fim:
+        ate = min(fim, dia + janela - timedelta(days=1))
+        yield dict(params, inicio=dia, fim=ate)
+        dia = ate + timedelta(days=1)
+        janela *= 2
+
+
+def search_params(inicio, fim, agora, limite, depois, clinica, especialidade, medico):
+    ''' Gets the SEARCH_FREE_SLOTS parameters of the whole range, for
+    streaming it in one go (<limite> None means no limit). '''
+    data, hora, nif = depois or (inicio - timedelta(days=1), time(0), "")
+    return {"inicio": max(inicio, data, agora.date()),
+            "fim": fim,
+            "horas": HORAS,
+            "agora": agora,
+            "data": data,
+            "hora": hora,
+            "nif": nif,
+            "clinica": clinica,
+            "especialidade": especialidade,
+            "medico": medico,
+            "n": limite}
+
+
+def encode_cursor(row):
+    ''' Gets the opaque pagination cursor that resumes after <row>. '''
+    chave = f"{row.data} {row.hora} {row.nif}"
+    return base64.urlsafe_b64encode(chave.encode()).decode()
+
+
+def decode_cursor(cursor):
+    ''' Gets the (data, hora, nif) key of <cursor>. Raises ValueError if
+    it is not a cursor made by encode_cursor(). '''
+    try:
+        data, hora, nif = base64.urlsafe_b64decode(cursor.encode()).decode().split(" ")
+        momento = datetime.strptime(f"{data} {hora}", "%Y-%m-%d %H:%M:%S")
+    except (ValueError, UnicodeError) as e:
+        raise ValueError(f"Cursor invalido: {cursor}") from e
+    return momento.date(), momento.time(), nif
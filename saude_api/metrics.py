@@ -0,0 +1,190 @@
+# Copyright (c) BDist Development Team
+# Distributed under the terms of the Modified BSD License.
+''' Per-request database instrumentation and Prometheus metrics.
+
+The pools create their connections with InstrumentedCursor /
+AsyncInstrumentedCursor as cursor factory. Every execute() is then
+charged to the current request: one round trip, the rows it returned and
+the time spent waiting on the database. The request is found through a
+context variable, so it works for threads (WSGI) and tasks (ASGI) alike.
+
+At the end of a request the totals go to the Server-Timing header and
+into per-route counters and latency histograms, rendered by render() in
+the Prometheus text format. Recording costs a couple of perf_counter()
+calls per query and one lock per request. '''
+import bisect
+import threading
+import time
+from contextvars import ContextVar
+
+import psycopg
+
+# Upper bounds (seconds) of the latency histogram buckets.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class RequestStats:
+    ''' Database work done by one request. '''
+
+    __slots__ = ("inicio", "round_trips", "rows", "db_time")
+
+    def __init__(self):
+        self.inicio = time.perf_counter()
+        self.round_trips = 0
+        self.rows = 0
+        self.db_time = 0.0
+
+    def record(self, rows, tempo):
+        self.round_trips += 1
+        self.rows += max(rows, 0)
+        self.db_time += tempo
+
+
+_atual = ContextVar("saude_request_stats", default=None)
+
+
+class InstrumentedCursor(psycopg.Cursor):
+    ''' Cursor that charges its queries to the current request. '''
+
+    def execute(self, *args, **kwargs):
+        stats = _atual.get()
+        if stats is None:
+            return super().execute(*args, **kwargs)
+
+        inicio = time.perf_counter()
+        try:
+            return super().execute(*args, **kwargs)
+        finally:
+            stats.record(self.rowcount, time.perf_counter() - inicio)
+
+
+class AsyncInstrumentedCursor(psycopg.AsyncCursor):
+    ''' InstrumentedCursor for async connections. '''
+
+    async def execute(self, *args, **kwargs):
+        stats = _atual.get()
+        if stats is None:
+            return await super().execute(*args, **kwargs)
+
+        inicio = time.perf_counter()
+        try:
+            return await super().execute(*args, **kwargs)
+        finally:
+            stats.record(self.rowcount, time.perf_counter() - inicio)
+
+
+def start():
+    ''' Starts recording the current request. '''
+    _atual.set(RequestStats())
+
+
+def finish(route, method, status):
+    ''' Stops recording the current request, adds it to the route metrics
+    and returns its RequestStats (None if it wasn't being recorded). '''
+    stats = _atual.get()
+    if stats is None:
+        return None
+    _atual.set(None)
+
+    _registry.observe(route, method, status, stats, time.perf_counter() - stats.inicio)
+    return stats
+
+
+def server_timing(stats):
+    ''' Gets the Server-Timing header value of a finished request. '''
+    total = (time.perf_counter() - stats.inicio) * 1000
+    return (f'db;dur={stats.db_time * 1000:.2f};desc="{stats.round_trips} round trips, '
+            f'{stats.rows} rows", total;dur={total:.2f}')
+
+
+class Histogram:
+
+    __slots__ = ("counts", "soma", "n")
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.soma = 0.0
+        self.n = 0
+
+    def observe(self, valor):
+        i = bisect.bisect_left(BUCKETS, valor)
+        if i < len(BUCKETS):
+            self.counts[i] += 1
+        self.soma += valor
+        self.n += 1
+
+
+class MetricsRegistry:
+    ''' Per-route request counters and histograms. '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requests = {}     # (route, method, status): n
+        self._latencia = {}     # (route, method): Histogram
+        self._db = {}           # (route, method): Histogram
+        self._round_trips = {}  # (route, method): n
+        self._rows = {}         # (route, method): n
+
+    def observe(self, route, method, status, stats, duracao):
+        chave = (route, method)
+        with self._lock:
+            self._requests[(route, method, status)] = self._requests.get((route, method, status), 0) + 1
+            self._latencia.setdefault(chave, Histogram()).observe(duracao)
+            self._db.setdefault(chave, Histogram()).observe(stats.db_time)
+            self._round_trips[chave] = self._round_trips.get(chave, 0) + stats.round_trips
+            self._rows[chave] = self._rows.get(chave, 0) + stats.rows
+
+    def render(self):
+        ''' Gets every metric in the Prometheus text exposition format. '''
+        with self._lock:
+            linhas = [
+                "# HELP saude_requests_total Requests served.",
+                "# TYPE saude_requests_total counter",
+            ]
+            for (route, method, status), n in sorted(self._requests.items()):
+                linhas.append(f'saude_requests_total{{{labels(route, method)},status="{status}"}} {n}')
+
+            for nome, ajuda, histogramas in (
+                    ("saude_request_duration_seconds", "Request latency.", self._latencia),
+                    ("saude_request_db_seconds", "Time spent on the database per request.", self._db)):
+                linhas.append(f"# HELP {nome} {ajuda}")
+                linhas.append(f"# TYPE {nome} histogram")
+                for (route, method), h in sorted(histogramas.items()):
+                    acumulado = 0
+                    for limite, n in zip(BUCKETS, h.counts):
+                        acumulado += n
+                        linhas.append(f'{nome}_bucket{{{labels(route, method)},le="{limite}"}} {acumulado}')
+                    linhas.append(f'{nome}_bucket{{{labels(route, method)},le="+Inf"}} {h.n}')
+                    linhas.append(f'{nome}_sum{{{labels(route, method)}}} {h.soma}')
+                    linhas.append(f'{nome}_count{{{labels(route, method)}}} {h.n}')
+
+            for nome, ajuda, contadores in (
+                    ("saude_db_round_trips_total", "Database round trips.", self._round_trips),
+                    ("saude_db_rows_total", "Rows returned by the database.", self._rows)):
+                linhas.append(f"# HELP {nome} {ajuda}")
+                linhas.append(f"# TYPE {nome} counter")
+                for (route, method), n in sorted(contadores.items()):
+                    linhas.append(f'{nome}{{{labels(route, method)}}} {n}')
+
+        return "\n".join(linhas) + "\n"
+
+
+def labels(route, method):
+    route = route.replace("\\", "\\\\").replace('"', '\\"')
+    return f'route="{route}",method="{method}"'
+
+
+_registry = MetricsRegistry()
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def render():
+    ''' Gets the route metrics in the Prometheus text format. '''
+    return _registry.render()
+
+
+def route_label(req):
+    ''' Gets the route template of <req>, so /c/<clinica>/ is one series
+    and not one per clinic. '''
+    return req.url_rule.rule if req.url_rule is not None else "<unmatched>"
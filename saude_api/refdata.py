@@ -0,0 +1,165 @@
+# Copyright (c) BDist Development Team
+# Distributed under the terms of the Modified BSD License.
+''' In-process cache of the reference tables clinica, medico and trabalha.
+
+They are tiny and almost static, so the existence checks are answered from
+memory. Entries expire after a TTL, can be dropped explicitly with
+invalidate(), and optionally as soon as the tables change, by listening
+on the 'refdata' channel notified by the triggers in saude.sql. '''
+import logging
+import threading
+import time
+from collections import namedtuple
+
+import psycopg
+
+from statements import registry
+
+log = logging.getLogger(__name__)
+
+Referencia = namedtuple(
+    "Referencia",
+    [
+        "clinicas",                 # {nome}
+        "medicos",                  # {nif: especialidade}
+        "especialidades",           # {especialidade}
+        "especialidades_clinica",   # {clinica: {especialidade}}
+        "trabalha",                 # {(nif, dia_da_semana): clinica}
+        "carregada",                # time.monotonic() of the load
+    ],
+)
+
+
+# clinica, medico and trabalha, in the order _build() takes them
+QUERIES = (
+    registry.register("refdata_clinica", """
+    SELECT nome
+    FROM clinica;
+    """),
+    registry.register("refdata_medico", """
+    SELECT nif, especialidade
+    FROM medico;
+    """),
+    registry.register("refdata_trabalha", """
+    SELECT nif, nome, dia_da_semana
+    FROM trabalha;
+    """),
+)
+
+
+class RefDataCache:
+    ''' Reference data snapshot, reloaded when older than <ttl> seconds. '''
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._data = None
+        self._geracao = 0
+        self._lock = threading.Lock()
+        self._listener = None
+
+    def get(self, cur):
+        ''' Gets the current snapshot, loading it through <cur> if needed. '''
+        data = self._fresh()
+        if data is not None:
+            return data
+
+        with self._lock:
+            data = self._fresh()
+            if data is not None:
+                return data
+
+            self.misses += 1
+            geracao = self._geracao
+            data = self._build(*(registry.execute(cur, q).fetchall() for q in QUERIES))
+            return self._store(data, geracao)
+
+    async def aget(self, acur):
+        ''' get() for an async cursor. Concurrent misses may load twice,
+        which is harmless. '''
+        data = self._fresh()
+        if data is not None:
+            return data
+
+        self.misses += 1
+        geracao = self._geracao
+        rows = []
+        for q in QUERIES:
+            await registry.aexecute(acur, q)
+            rows.append(await acur.fetchall())
+        return self._store(self._build(*rows), geracao)
+
+    def _fresh(self):
+        data = self._data
+        if data is not None and time.monotonic() - data.carregada < self.ttl:
+            self.hits += 1
+            return data
+        return None
+
+    def _store(self, data, geracao):
+        # Invalidada a meio do carregamento: usa-a so neste pedido.
+        if geracao == self._geracao:
+            self._data = data
+        return data
+
+    def invalidate(self):
+        ''' Drops the current snapshot. '''
+        self._geracao += 1
+        self._data = None
+        self.invalidations += 1
+
+    def stats(self):
+        data = self._data
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "ttl": self.ttl,
+            "age": None if data is None else time.monotonic() - data.carregada,
+            "listening": self._listener is not None,
+        }
+
+    @staticmethod
+    def _build(clinicas, medicos, trabalha_rows):
+        medicos = dict(medicos)
+        trabalha = {}
+        especialidades_clinica = {}
+        for nif, clinica, dia in trabalha_rows:
+            trabalha[(nif, dia)] = clinica
+            if nif in medicos:
+                especialidades_clinica.setdefault(clinica, set()).add(medicos[nif])
+
+        return Referencia(
+            clinicas=frozenset(r[0] for r in clinicas),
+            medicos=medicos,
+            especialidades=frozenset(medicos.values()),
+            especialidades_clinica=especialidades_clinica,
+            trabalha=trabalha,
+            carregada=time.monotonic(),
+        )
+
+    def listen(self, conninfo):
+        ''' Starts, once, a background thread that invalidates the cache on
+        every notification of the 'refdata' channel. '''
+        with self._lock:
+            if self._listener is not None:
+                return
+            self._listener = threading.Thread(
+                target=self._listen, args=(conninfo,), name="refdata-listener", daemon=True)
+            self._listener.start()
+
+    def _listen(self, conninfo):
+        while True:
+            try:
+                with psycopg.connect(conninfo, autocommit=True) as conn:
+                    conn.execute("LISTEN refdata;")
+                    # Alteracoes feitas enquanto nao estavamos a escuta.
+                    self.invalidate()
+                    for notify in conn.notifies():
+                        log.debug(f"{notify.payload} changed, invalidating reference data.")
+                        self.invalidate()
+            except psycopg.Error as e:
+                log.warning(f"Reference data listener failed: {e}")
+                time.sleep(5)
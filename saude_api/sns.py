@@ -0,0 +1,42 @@
+# Copyright (c) BDist Development Team
+# Distributed under the terms of the Modified BSD License.
+''' Allocation of unique codigo_sns values.
+
+A codigo_sns is built from a sequence number <n>: 11 digits obtained by
+scrambling <n> with a bijection of [0, 10^11), followed by a Luhn check
+digit. Distinct sequence numbers always give distinct codes, so no lookup
+in consulta is needed. The API draws <n> from codigo_sns_seq and
+generator.py uses the consulta id, resetting the sequence afterwards. '''
+
+MODULO = 10 ** 11
+# n -> (n * MULTIPLICADOR + DESLOCAMENTO) % MODULO is a bijection as long
+# as MULTIPLICADOR is coprime with 10.
+MULTIPLICADOR = 48_271_926_457
+DESLOCAMENTO = 31_415_926_535
+
+
+def digito_controlo(digitos):
+    ''' Gets the Luhn check digit for the string <digitos>. '''
+    soma = 0
+    for i, d in enumerate(reversed(digitos)):
+        d = int(d)
+        if i % 2 == 0:
+            d *= 2
+            if d > 9:
+                d -= 9
+        soma += d
+    return (10 - soma % 10) % 10
+
+
+def codigo_sns(n):
+    ''' Gets the 12-digit codigo_sns for sequence number <n>. '''
+    if not 0 <= n < MODULO:
+        raise ValueError(f"Numero de sequencia fora do intervalo: {n}")
+    corpo = f"{(n * MULTIPLICADOR + DESLOCAMENTO) % MODULO:011d}"
+    return corpo + str(digito_controlo(corpo))
+
+
+def valido(codigo):
+    ''' Checks the format and check digit of <codigo>. '''
+    return (len(codigo) == 12 and codigo.isdigit()
+            and digito_controlo(codigo[:-1]) == int(codigo[-1]))
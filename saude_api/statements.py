@@ -0,0 +1,68 @@
+# Copyright (c) BDist Development Team
+# Distributed under the terms of the Modified BSD License.
+''' Registry of the named statements run by the API.
+
+Registered statements are executed with prepare=True, so every pooled
+connection parses and plans each of them once and reuses the plan for as
+long as it lives, and with binary=True, so results come back in binary
+format. Executions and their cumulative time are counted per statement. '''
+import threading
+import time
+from collections import namedtuple
+
+Statement = namedtuple("Statement", "nome sql")
+
+
+class StatementRegistry:
+    ''' Named statements and their execution counters. '''
+
+    def __init__(self):
+        self._statements = {}
+        self._calls = {}
+        self._tempo = {}
+        self._lock = threading.Lock()
+
+    def register(self, nome, sql):
+        ''' Registers <sql> under <nome> and returns its Statement. '''
+        if nome in self._statements and self._statements[nome].sql != sql:
+            raise ValueError(f"Statement {nome} already registered with another query.")
+        statement = Statement(nome, sql)
+        self._statements[nome] = statement
+        self._calls.setdefault(nome, 0)
+        self._tempo.setdefault(nome, 0.0)
+        return statement
+
+    def execute(self, cur, statement, params=()):
+        ''' Executes <statement> on <cur>, prepared. Returns <cur>. '''
+        inicio = time.perf_counter()
+        try:
+            return cur.execute(statement.sql, params, prepare=True, binary=True)
+        finally:
+            self._count(statement, time.perf_counter() - inicio)
+
+    async def aexecute(self, acur, statement, params=()):
+        ''' execute() for an async cursor. '''
+        inicio = time.perf_counter()
+        try:
+            return await acur.execute(statement.sql, params, prepare=True, binary=True)
+        finally:
+            self._count(statement, time.perf_counter() - inicio)
+
+    def _count(self, statement, tempo):
+        with self._lock:
+            self._calls[statement.nome] += 1
+            self._tempo[statement.nome] += tempo
+
+    def stats(self):
+        ''' Gets the executions and time of every statement, the ones that
+        took the most time first. '''
+        with self._lock:
+            stats = [{"statement": nome,
+                      "calls": calls,
+                      "total_ms": round(self._tempo[nome] * 1000, 3),
+                      "mean_ms": round(self._tempo[nome] * 1000 / calls, 3) if calls else None}
+                     for nome, calls in self._calls.items()]
+        return sorted(stats, key=lambda s: s["total_ms"], reverse=True)
+
+
+registry = StatementRegistry()
@@ -0,0 +1,68 @@
+# Copyright (c) BDist Development Team
+# Distributed under the terms of the Modified BSD License.
+''' Streaming of large query results.
+
+Rows are read through a server-side cursor, <itersize> at a time, and
+encoded as they arrive, either as one JSON array or as NDJSON (one JSON
+value per line), so the memory used does not grow with the result. '''
+import json
+
+from psycopg.rows import namedtuple_row
+
+NDJSON = "application/x-ndjson"
+
+
+def wants_ndjson(req):
+    ''' Checks whether <req> asked for NDJSON, with ?formato=ndjson or its
+    Accept header. '''
+    return req.args.get("formato") == "ndjson" or req.accept_mimetypes.best == NDJSON
+
+
+def mimetype(ndjson):
+    return NDJSON if ndjson else "application/json"
+
+
+def stream_rows(connection, statement, params, encode, ndjson, itersize):
+    ''' Yields the JSON document of the rows of <statement> (see
+    statements.py), each one turned into a JSON value by <encode>.
+    <connection> borrows the connection, which is held until the last row
+    is sent. Named cursors can't be prepared, so <statement> runs as is. '''
+    with connection() as conn:
+        # os cursores do servidor so existem dentro de uma transacao
+        with conn.transaction():
+            with conn.cursor(name="saude_stream", row_factory=namedtuple_row) as cur:
+                cur.execute(statement.sql, params)
+                primeiro = True
+                while rows := cur.fetchmany(itersize):
+                    yield chunk(rows, encode, ndjson, primeiro)
+                    primeiro = False
+                yield fim(ndjson, primeiro)
+
+
+async def astream_rows(connection, statement, params, encode, ndjson, itersize):
+    ''' stream_rows() for an async <connection>. '''
+    async with connection() as conn:
+        async with conn.transaction():
+            async with conn.cursor(name="saude_stream", row_factory=namedtuple_row) as cur:
+                await cur.execute(statement.sql, params)
+                primeiro = True
+                while rows := await cur.fetchmany(itersize):
+                    yield chunk(rows, encode, ndjson, primeiro)
+                    primeiro = False
+                yield fim(ndjson, primeiro)
+
+
+def chunk(rows, encode, ndjson, primeiro):
+    ''' Encodes a batch of <rows>, the first one of the document if
+    <primeiro>. '''
+    valores = [json.dumps(encode(row)) for row in rows]
+    if ndjson:
+        return "\n".join(valores) + "\n"
+    return ("[" if primeiro else ",") + ",".join(valores)
+
+
+def fim(ndjson, vazio):
+    ''' Closes the document; <vazio> if no batch was sent. '''
+    if ndjson:
+        return ""
+    return "[]" if vazio else "]"
@@ -0,0 +1,83 @@
+# Copyright (c) BDist Development Team
+# Distributed under the terms of the Modified BSD License.
+''' Invariants of the appointments made by generator.py, on small
+deterministic datasets. '''
+import os
+import sys
+from datetime import datetime, time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import generator  # noqa: E402
+from saude_api import sns  # noqa: E402
+
+INICIO = datetime(2023, 1, 1)
+
+
+def dataset(pacientes=400, clinicas=3, fim=datetime(2023, 2, 11), seed=7, processos=1, vetorizado=False,
+            consultas_dia=20):
+    ''' Gets the patients, trabalha and appointments of a small dataset,
+    generated the way generator.py's main() does it. '''
+    generator.random.seed(seed)
+    generator.fake.seed_instance(seed)
+    generator._indices.clear()  # como num processo novo
+    clinic_data = generator.generate_clinic_data(clinicas, seed)
+    patients = generator.generate_patient_data(pacientes, seed, processos)
+    doctor_data = generator.generate_doctor_data(8 * clinicas, seed)
+    works_data = generator.generate_works_data(doctor_data, clinic_data)
+    consultas, _receitas, _observacoes = generator.gerar_consultas_receitas(
+        patients, doctor_data, clinic_data, INICIO, fim, works_data, seed, processos, vetorizado, consultas_dia)
+    return patients, works_data, consultas
+
+
+def check_invariants(patients, works_data, consultas):
+    nif_paciente = {p[0]: p[1] for p in patients}
+    clinica_do_dia = {(t[0], t[2]): t[1] for t in works_data}
+    medicos = set()
+    pacientes = set()
+    for id, ssn, nif, clinica, data, hora, codigo_sns in consultas:
+        # nem o medico nem o paciente tem duas consultas a mesma hora
+        assert (nif, data, hora) not in medicos
+        assert (ssn, data, hora) not in pacientes
+        medicos.add((nif, data, hora))
+        pacientes.add((ssn, data, hora))
+
+        dia_da_semana = datetime.strptime(data, "%Y-%m-%d").isoweekday() % 7
+        assert clinica_do_dia.get((nif, dia_da_semana)) == clinica
+        assert nif_paciente[ssn] != nif
+        h = time.fromisoformat(hora)
+        assert (time(8) <= h <= time(12, 30) or time(14) <= h <= time(18, 30)) and h.minute in (0, 30)
+        assert sns.valido(codigo_sns)
+
+    assert [c[0] for c in consultas] == list(range(1, len(consultas) + 1))
+    assert len({c[6] for c in consultas}) == len(consultas)
+    assert {c[1] for c in consultas} == set(nif_paciente)
+
+
+@pytest.mark.parametrize("processos", [1, 2])
+def test_invariants(processos):
+    patients, works_data, consultas = dataset(processos=processos)
+    check_invariants(patients, works_data, consultas)
+    generator.verificar_consultas(consultas, works_data, patients)
+
+
+def test_invariants_vetorizado():
+    pytest.importorskip("numpy")
+    patients, works_data, consultas = dataset(vetorizado=True)
+    check_invariants(patients, works_data, consultas)
+
+
+def test_same_output_for_any_number_of_processes():
+    assert dataset(processos=1) == dataset(processos=3)
+
+
+def test_many_patients_without_appointments():
+    # mais pacientes sem consulta do que cabem nos DIAS_RESERVA dias
+    patients, works_data, consultas = dataset(pacientes=20000, fim=datetime(2023, 3, 1))
+    check_invariants(patients, works_data, consultas)
+
+
+def test_period_too_short():
+    with pytest.raises(ValueError, match="horas livres"):
+        dataset(pacientes=4000, fim=datetime(2023, 1, 7))